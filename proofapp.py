@@ -1,9 +1,18 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import re
 import io
+import tempfile
 import plotly.graph_objects as go
 
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    # pandas' openpyxl reader already loads workbooks in read_only mode
+    EXCEL_ENGINE = 'openpyxl'
+
 # --- Page Configuration ---
 st.set_page_config(page_title="Financial Reconciler | Secure Portal", page_icon="🔐", layout="wide")
 
@@ -44,26 +53,102 @@ def check_password():
     return True
 
 # --- Logic Functions ---
-def extract_numeric_key(description):
-    if pd.isna(description): return None
-    match = re.search(r'\d{8,}', str(description))
-    return match.group(0) if match else None
-
-def extract_text_key(description):
-    if pd.isna(description): return ''
-    words = re.findall(r'[A-Z0-9]+', str(description).upper())
-    stopwords = {'THE', 'AND', 'OR', 'A', 'AN', 'BUT', 'OF', 'TO', 'FOR', 'WITH', 'ON', 'FROM', 'REVERSAL', 'REF', 'TRF', 'PAYMENT', 'PAID'}
-    keywords = [word for word in words if word not in stopwords and len(word) > 2]
-    unique_keywords = sorted(list(set(keywords)))
-    return ''.join(unique_keywords[:3]) if unique_keywords else ''
-
-def extract_match_key(row):
-    if row['Match_Key_Ref'] is not None:
-        return row['Match_Key_Ref']
-    text_key = row['Match_Key_Text']
-    if text_key:
-        return f"{text_key}_{round(abs(row['Net_Value']), 2)}"
-    return f"NO_KEY_VALUE_{round(row['Net_Value'], 2)}"
+_NUM_RE = re.compile(r'(\d{8,})')
+_STOPWORDS = frozenset({'THE', 'AND', 'OR', 'A', 'AN', 'BUT', 'OF', 'TO', 'FOR', 'WITH', 'ON', 'FROM', 'REVERSAL', 'REF', 'TRF', 'PAYMENT', 'PAID'})
+# Whole [A-Z0-9] runs of 3+ characters that are not stopwords
+_GOOD_TOKEN_RE = re.compile(r'(?<![A-Z0-9])(?!(?:%s)(?![A-Z0-9]))[A-Z0-9]{3,}'
+                            % '|'.join(sorted(word for word in _STOPWORDS if len(word) > 2)))
+
+def extract_text_key(descriptions):
+    tokens = descriptions.fillna('').str.upper().str.findall(_GOOD_TOKEN_RE)
+    return tokens.map(lambda words: ''.join(sorted(set(words))[:3]))
+
+def extract_match_key(df):
+    text_key = df['Match_Key_Text']
+    text_key_full = text_key + '_' + df['Net_Value'].abs().round(2).astype(str)
+    fallback = 'NO_KEY_VALUE_' + df['Net_Value'].round(2).astype(str)
+    return np.where(df['Match_Key_Ref'].notna(), df['Match_Key_Ref'],
+                    np.where(text_key.astype(bool), text_key_full, fallback))
+
+def _apply_formats(worksheet, date_fmt, num_fmt):
+    worksheet.set_column(0, 0, 12, date_fmt)
+    worksheet.set_column(3, 7, 15, num_fmt)
+
+def write_sheet(workbook, sheet_name, df, header_fmt, date_fmt, num_fmt):
+    # constant_memory flushes each row once written, so cells must go out row by row
+    worksheet = workbook.add_worksheet(sheet_name)
+    _apply_formats(worksheet, date_fmt, num_fmt)
+    worksheet.write_row(0, 0, [EXPORT_HEADERS.get(col, col) for col in df.columns], header_fmt)
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False), start=1):
+        worksheet.write_row(row_idx, 0, row)
+    return worksheet
+
+REQUIRED_COLS = ['Date', 'Reference', 'Description', 'Value', 'Deposit', 'Withdrawal', 'Balance']
+FINAL_COLS = ['Date', 'Reference', 'Description', 'Value', 'Deposit', 'Withdrawal', 'Net_Value', 'Balance']
+EXPORT_HEADERS = {'Net_Value': 'Amount'}
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=600)
+def reconcile(file_bytes):
+    """Splits a statement into matched/unmatched entries; returns None if columns are missing."""
+    df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=0, parse_dates=['Date'], dtype={'Description': str}, engine=EXCEL_ENGINE)
+    if not all(col in df.columns for col in REQUIRED_COLS):
+        return None
+
+    balance_rows = np.flatnonzero(df['Deposit'].isna().to_numpy() & df['Withdrawal'].isna().to_numpy())
+    if not balance_rows.size:
+        df_transactions, df_ob, df_cb = df.copy(), pd.DataFrame(), pd.DataFrame()
+    else:
+        idx_ob, idx_cb = balance_rows[0], balance_rows[-1]
+        df_ob, df_cb = df.iloc[[idx_ob]].copy(), df.iloc[[idx_cb]].copy()
+        df_transactions = df.iloc[idx_ob + 1 : idx_cb].copy()
+
+    df_transactions['Match_Key_Ref'] = df_transactions['Description'].str.extract(_NUM_RE, expand=False)
+    # Reference numbers take priority, so only rows without one need text tokenizing
+    df_transactions['Match_Key_Text'] = extract_text_key(df_transactions['Description'].mask(df_transactions['Match_Key_Ref'].notna()))
+    deposit = np.nan_to_num(df_transactions['Deposit'].to_numpy(dtype=float))
+    withdrawal = np.nan_to_num(df_transactions['Withdrawal'].to_numpy(dtype=float))
+    net = np.subtract(deposit, withdrawal)
+    df_transactions['Deposit'], df_transactions['Withdrawal'] = deposit, withdrawal
+    df_transactions['Net_Value'] = net
+    df_transactions['Match_Key'] = pd.Categorical(extract_match_key(df_transactions))
+
+    codes = df_transactions['Match_Key'].cat.codes.to_numpy()
+    net_by_code = np.bincount(codes, weights=net, minlength=len(df_transactions['Match_Key'].cat.categories))
+    is_matched = (np.round(net_by_code, 4) == 0)[codes]
+    return df_transactions[is_matched], df_transactions[~is_matched], df_ob, df_cb
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=600)
+def build_xlsx(file_bytes, _df_matched, _df_unmatched, _df_ob, _df_cb):
+    """Assembles the two-sheet reconciled report and returns the workbook bytes.
+
+    Cached on the uploaded bytes; the frames are reconcile()'s output for them and are not hashed.
+    """
+    # Single allocation for opening balance + unmatched + closing balance; empty balance frames have no columns
+    parts = [_df_ob, _df_unmatched, _df_cb]
+    unmatched_values = np.full((sum(len(part) for part in parts), len(FINAL_COLS)), np.nan, dtype=object)
+    start = 0
+    for part in parts:
+        for col_idx, col in enumerate(FINAL_COLS):
+            if col in part.columns:
+                unmatched_values[start : start + len(part), col_idx] = part[col].to_numpy(dtype=object)
+        start += len(part)
+    df_unmatched_out = pd.DataFrame(unmatched_values, columns=FINAL_COLS)
+    df_matched_out = _df_matched.iloc[np.argsort(_df_matched['Match_Key'].cat.codes.to_numpy(), kind='stable')][FINAL_COLS]
+
+    xlsx_options = {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'}
+    # Large reports spill to disk instead of growing an in-memory buffer
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as output:
+        with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': xlsx_options}) as writer:
+            # Basic Formatting (set up front, rows are streamed out as they are written)
+            workbook = writer.book
+            header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+            date_fmt = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+            num_fmt = workbook.add_format({'num_format': '#,##0.00'})
+            write_sheet(workbook, 'Unmatched Statement', df_unmatched_out, header_fmt, date_fmt, num_fmt)
+            write_sheet(workbook, 'Matched Entries', df_matched_out, header_fmt, date_fmt, num_fmt)
+        output.seek(0)
+        return output.read()
 
 # --- Authenticated App Content ---
 if check_password():
@@ -71,6 +156,8 @@ if check_password():
     with st.sidebar:
         st.header("🛠️ Operations")
         if st.button("🔄 Reset App & Clear Data"):
+            reconcile.clear()
+            build_xlsx.clear()
             st.rerun()
             
         st.markdown("---")
@@ -98,39 +185,18 @@ if check_password():
 
     if uploaded_file:
         try:
-            df = pd.read_excel(uploaded_file, sheet_name=0, parse_dates=['Date'], dtype={'Description': str})
-            required_cols = ['Date', 'Reference', 'Description', 'Value', 'Deposit', 'Withdrawal', 'Balance']
+            file_bytes = uploaded_file.getvalue()
+            result = reconcile(file_bytes)
             
-            if not all(col in df.columns for col in required_cols):
-                st.error(f"⚠️ Column Mismatch! The file must have: {', '.join(required_cols)}")
+            if result is None:
+                st.error(f"⚠️ Column Mismatch! The file must have: {', '.join(REQUIRED_COLS)}")
             else:
-                # Reconcile Process
-                balance_rows = df[df['Deposit'].isna() & df['Withdrawal'].isna()]
-                if balance_rows.empty:
-                    df_transactions, df_ob, df_cb = df.copy(), pd.DataFrame(), pd.DataFrame()
-                else:
-                    idx_ob, idx_cb = balance_rows.index[0], balance_rows.index[-1]
-                    df_ob, df_cb = df.loc[[idx_ob]].copy(), df.loc[[idx_cb]].copy()
-                    df_transactions = df.iloc[idx_ob + 1 : idx_cb].copy()
-
-                df_transactions['Match_Key_Ref'] = df_transactions['Description'].apply(extract_numeric_key)
-                df_transactions['Match_Key_Text'] = df_transactions['Description'].apply(extract_text_key)
-                df_transactions['Deposit'] = df_transactions['Deposit'].fillna(0)
-                df_transactions['Withdrawal'] = df_transactions['Withdrawal'].fillna(0)
-                df_transactions['Net_Value'] = df_transactions['Deposit'] - df_transactions['Withdrawal']
-                df_transactions['Amount'] = df_transactions['Net_Value']
-                df_transactions['Match_Key'] = df_transactions.apply(extract_match_key, axis=1)
-
-                grouped_net = df_transactions.groupby('Match_Key')['Net_Value'].sum()
-                matched_keys = grouped_net[grouped_net.round(4) == 0].index.tolist()
-
-                df_matched = df_transactions[df_transactions['Match_Key'].isin(matched_keys)].copy()
-                df_unmatched = df_transactions[~df_transactions['Match_Key'].isin(matched_keys)].copy()
+                df_matched, df_unmatched, df_ob, df_cb = result
 
                 # Dashboard Summary
                 st.markdown("---")
                 m1, m2, m3 = st.columns(3)
-                m1.metric("Rows Processed", len(df_transactions))
+                m1.metric("Rows Processed", len(df_matched) + len(df_unmatched))
                 m2.metric("Matched (Netted)", len(df_matched))
                 m3.metric("Unmatched items", len(df_unmatched))
 
@@ -142,31 +208,15 @@ if check_password():
                     fig_pie.update_layout(title="Volume Breakdown")
                     st.plotly_chart(fig_pie, use_container_width=True)
                 with c2:
-                    unmatched_sum = df_unmatched['Amount'].sum()
+                    unmatched_sum = df_unmatched['Net_Value'].sum()
                     fig_ind = go.Figure(go.Indicator(mode="number+delta", value=unmatched_sum,
                                                      number={'prefix': "$", 'valueformat': ",.2f"},
                                                      title={"text": "Total Net Exposure (Unmatched)"},
                                                      delta={'reference': 0}))
                     st.plotly_chart(fig_ind, use_container_width=True)
 
-                # Export Assembly
-                final_cols = ['Date', 'Reference', 'Description', 'Value', 'Deposit', 'Withdrawal', 'Amount', 'Balance']
-                df_unmatched_out = pd.concat([df_ob, df_unmatched.drop(columns=['Match_Key', 'Net_Value', 'Match_Key_Ref', 'Match_Key_Text']), df_cb])[final_cols]
-                df_matched_out = df_matched.sort_values(by='Match_Key').drop(columns=['Match_Key', 'Net_Value', 'Match_Key_Ref', 'Match_Key_Text'])[final_cols]
-
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df_unmatched_out.to_excel(writer, sheet_name='Unmatched Statement', index=False)
-                    df_matched_out.to_excel(writer, sheet_name='Matched Entries', index=False)
-                    
-                    # Basic Formatting
-                    workbook = writer.book
-                    num_fmt = workbook.add_format({'num_format': '#,##0.00'})
-                    for sheet_name in writer.sheets:
-                        writer.sheets[sheet_name].set_column('D:H', 15, num_fmt)
-
                 st.markdown("### 📥 Ready for Download")
-                st.download_button(label="Download Reconciled Report", data=output.getvalue(), 
+                st.download_button(label="Download Reconciled Report", data=build_xlsx(file_bytes, df_matched, df_unmatched, df_ob, df_cb), 
                                    file_name="Reconciled_Report.xlsx", 
                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                    type="primary")